@@ -1,8 +1,7 @@
-import os
-import pickle
 from pathlib import Path
 import random
 from typing import Union
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.utils.data import Dataset
@@ -17,23 +16,65 @@ class EPianoDataset(Dataset):
     """
     ----------
     Author: Damon Gwinn
+    Changes : David Pardigol
     ----------
     Pytorch Dataset for the Maestro e-piano dataset (https://magenta.tensorflow.org/datasets/maestro).
     Recommended to use with Dataloader (https://pytorch.org/docs/stable/data.html#torch.utils.data.DataLoader)
 
-    Uses all files found in the given root directory of pre-processed (preprocess_midi.py)
-    Maestro midi files.
+    Uses the token shard found in the given root directory of pre-processed (preprocess_midi.py)
+    Maestro midi files. The shard is memory-mapped, so pieces are sliced out of it instead of
+    being read from one file each.
     ----------
     """
 
     def __init__(self, root:Path, max_seq=2048, random_seq=True):
 
-        self.root       = root
+        self.root       = Path(root)
         self.max_seq    = max_seq
         self.random_seq = random_seq
 
-        fs = [os.path.join(root, f) for f in os.listdir(self.root)]
-        self.data_files = [f for f in fs if os.path.isfile(f)]
+        self.offsets    = np.load(self.root / OFFSETS_FILE)
+        with open(self.root / NAMES_FILE, "r") as i_stream:
+            self.data_files = i_stream.read().splitlines()
+
+        # Opened lazily so that each Dataloader worker maps the shard itself
+        self._tokens    = None
+
+    # __getstate__
+    def __getstate__(self):
+        """
+        ----------
+        Author: David Pardigol
+        ----------
+        Drops the memory map when pickled (Dataloader workers), a pickled memmap is a full copy
+        ----------
+        """
+
+        state = self.__dict__.copy()
+        state["_tokens"] = None
+        return state
+
+    # tokens
+    @property
+    def tokens(self):
+        """
+        ----------
+        Author: David Pardigol
+        ----------
+        Memory-mapped token shard, opened on first use
+        ----------
+        """
+
+        if(self._tokens is None):
+            tokens_file = self.root / TOKENS_FILE
+
+            # np.memmap cannot map an empty file
+            if(tokens_file.stat().st_size == 0):
+                self._tokens = np.empty(0, dtype=TOKEN_DTYPE)
+            else:
+                self._tokens = np.memmap(tokens_file, dtype=TOKEN_DTYPE, mode="r")
+
+        return self._tokens
 
     # __len__
     def __len__(self):
@@ -41,11 +82,11 @@ class EPianoDataset(Dataset):
         ----------
         Author: Damon Gwinn
         ----------
-        How many data files exist in the given directory
+        How many pieces exist in the given directory
         ----------
         """
 
-        return len(self.data_files)
+        return len(self.offsets) - 1
 
     # __getitem__
     def __getitem__(self, idx):
@@ -60,14 +101,90 @@ class EPianoDataset(Dataset):
         """
 
         # All data on cpu to allow for the Dataloader to multithread
-        with open(self.data_files[idx], "rb") as i_stream:
-            # return pickle.load(i_stream), None
-            raw_mid     = torch.tensor(pickle.load(i_stream), dtype=TORCH_LABEL_TYPE, device=cpu_device())
+        start   = self.offsets[idx]
+        end     = self.offsets[idx+1]
+        raw_mid = torch.tensor(self.tokens[start:end], dtype=TORCH_LABEL_TYPE, device=cpu_device())
 
         x, tgt = process_midi(raw_mid, self.max_seq, self.random_seq)
 
         return x, tgt
 
+# EPianoWindowDataset
+class EPianoWindowDataset(Dataset):
+    """
+    ----------
+    Author: David Pardigol
+    ----------
+    Pytorch Dataset over the fixed training windows of a split (preprocess_midi.py with -max_sequence).
+    Each item is a memory-mapped window row split into the input and the target shifted by one,
+    so no cropping or padding is done per item.
+    ----------
+    """
+
+    def __init__(self, windows_file:Path):
+
+        self.windows_file   = Path(windows_file)
+        self.n_windows      = np.load(self.windows_file, mmap_mode="r").shape[0]
+
+        # Opened lazily so that each Dataloader worker maps the file itself
+        self._windows       = None
+
+    # __getstate__
+    def __getstate__(self):
+        """
+        ----------
+        Author: David Pardigol
+        ----------
+        Drops the memory map when pickled (Dataloader workers), a pickled memmap is a full copy
+        ----------
+        """
+
+        state = self.__dict__.copy()
+        state["_windows"] = None
+        return state
+
+    # windows
+    @property
+    def windows(self):
+        """
+        ----------
+        Author: David Pardigol
+        ----------
+        Memory-mapped (n_windows, max_seq + 1) window array, opened on first use
+        ----------
+        """
+
+        if(self._windows is None):
+            self._windows = np.load(self.windows_file, mmap_mode="r")
+
+        return self._windows
+
+    # __len__
+    def __len__(self):
+        """
+        ----------
+        Author: David Pardigol
+        ----------
+        How many windows exist in the windows file
+        ----------
+        """
+
+        return self.n_windows
+
+    # __getitem__
+    def __getitem__(self, idx):
+        """
+        ----------
+        Author: David Pardigol
+        ----------
+        Gets the indexed window. Returns the input and the target.
+        ----------
+        """
+
+        window = torch.tensor(self.windows[idx], dtype=TORCH_LABEL_TYPE, device=cpu_device())
+
+        return window[:-1], window[1:]
+
 # process_midi
 def process_midi(raw_mid, max_seq, random_seq):
     """
@@ -117,24 +234,37 @@ def process_midi(raw_mid, max_seq, random_seq):
 
 
 # create_epiano_datasets
-def create_epiano_datasets(dataset_root:Union[str,Path], max_seq, random_seq=True):
+def create_epiano_datasets(dataset_root:Union[str,Path], max_seq, random_seq=True, windowed=False):
     """
     ----------
     Author: Damon Gwinn
+    Changes : David Pardigol
     ----------
     Creates train, evaluation, and test EPianoDataset objects for a pre-processed (preprocess_midi.py)
     root containing train, val, and test folders.
+
+    With windowed, the train dataset is an EPianoWindowDataset instead when the windows for max_seq
+    were pre-processed (random_seq is then unused for it). The val and test datasets always crop one
+    sequence per piece, matching evaluate.py.
     ----------
     """
     dataset_root = Path(dataset_root)
 
-    train_root = dataset_root / "train"
-    val_root = dataset_root / "val"
-    test_root = dataset_root / "test"
+    roots = [dataset_root / "train", dataset_root / "val", dataset_root / "test"]
+
+    train_dataset = None
+    if(windowed):
+        windows_file = roots[0] / WINDOWS_FILE.format(max_seq)
+        if(windows_file.is_file()):
+            train_dataset = EPianoWindowDataset(windows_file)
+        else:
+            print("WARNING: No pre-processed train windows for max_sequence", max_seq, "found, cropping pieces on the fly")
+            print("")
 
-    train_dataset = EPianoDataset(train_root, max_seq, random_seq)
-    val_dataset = EPianoDataset(val_root, max_seq, random_seq)
-    test_dataset = EPianoDataset(test_root, max_seq, random_seq)
+    if(train_dataset is None):
+        train_dataset = EPianoDataset(roots[0], max_seq, random_seq)
+    val_dataset = EPianoDataset(roots[1], max_seq, random_seq)
+    test_dataset = EPianoDataset(roots[2], max_seq, random_seq)
 
     return train_dataset, val_dataset, test_dataset
 
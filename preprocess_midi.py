@@ -1,26 +1,68 @@
 import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import pickle
-import json
 import random
 from typing import Union
 
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# orjson is faster but optional, both parse the json from bytes
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
 import third_party.midi_processor.processor as midi_processor
+from utilities.token_constants import TOKEN_DTYPE, TOKENS_FILE, OFFSETS_FILE, NAMES_FILE, WINDOWS_FILE, TOKEN_END, TOKEN_PAD
 
 JSON_FILE = "maestro-v2.0.0.json"
 
+# Number of tasks handed to a worker at once, amortizes the inter-process communication
+POOL_CHUNKSIZE = 8
+
+# Write buffer for the token shards, keeps the number of write syscalls per file low
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Shard files are written under this suffix and only renamed once every split was encoded
+TMP_SUFFIX = ".tmp"
+
+# _encode_one
+def _encode_one(mid):
+    """
+    ----------
+    Author: David Pardigol
+    ----------
+    Worker for prep_maestro_midi. Encodes a single midi file and returns its tokens as a
+    TOKEN_DTYPE array. Kept at module level so it can be sent to the process pool.
+    ----------
+    """
+
+    # pretty_midi only treats str as a file name
+    prepped = midi_processor.encode_midi(str(mid))
+
+    return np.asarray(prepped, dtype=TOKEN_DTYPE)
+
 # prep_midi
-def prep_maestro_midi(maestro_root:Union[str,Path], output_dir:Union[str,Path]):
+def prep_maestro_midi(maestro_root:Union[str,Path], output_dir:Union[str,Path], max_seq=None):
     """
     ----------
     Author: Damon Gwinn
     Changes : David Pardigol
     ----------
     Pre-processes the maestro dataset, putting processed midi data (train, eval, test) into the
-    given output folder
+    given output folder.
+
+    Each split folder holds a single shard: the tokens of every piece concatenated in TOKENS_FILE,
+    the token offset of each piece in OFFSETS_FILE and the piece names in NAMES_FILE. The files are
+    written to temporary names first, so a failed run leaves the previous shards untouched. Windows
+    cut from a replaced shard are deleted.
+
+    With max_seq given, the train split is also cut into fixed training windows (see prep_windows).
     ----------
     """
+
     maestro_root = Path(maestro_root)
     output_dir = Path(output_dir)
 
@@ -37,8 +79,10 @@ def prep_maestro_midi(maestro_root:Union[str,Path], output_dir:Union[str,Path]):
         print("ERROR: Could not find file:", maestro_json_file)
         return False
 
-    maestro_json = json.load(open(maestro_json_file, "r"))
-    print("Found", len(maestro_json), "pieces")
+    with open(maestro_json_file, "rb") as i_stream:
+        maestro_json = _json.loads(i_stream.read())
+    entries = [(maestro_root / piece["midi_filename"], piece["split"]) for piece in maestro_json]
+    print("Found", len(entries), "pieces")
     print("Preprocessing...")
 
     total_count = 0
@@ -46,38 +90,115 @@ def prep_maestro_midi(maestro_root:Union[str,Path], output_dir:Union[str,Path]):
     val_count   = 0
     test_count  = 0
 
-    for piece in maestro_json:
-        mid         = os.path.join(maestro_root, piece["midi_filename"])
-        split_type  = piece["split"]
-        f_name      = mid.split("/")[-1] + ".pickle"
-
+    tasks = []
+    for mid, split_type in entries:
         if(split_type == "train"):
-            o_file = train_dir / f_name
+            split_dir = train_dir
             train_count += 1
         elif(split_type == "validation"):
-            o_file = val_dir / f_name
+            split_dir = val_dir
             val_count += 1
         elif(split_type == "test"):
-            o_file = test_dir / f_name
+            split_dir = test_dir
             test_count += 1
         else:
             print("ERROR: Unrecognized split type:", split_type)
             return False
 
-        prepped = midi_processor.encode_midi(mid)
-
-        with open(o_file, "wb") as o_stream:
-            pickle.dump(prepped, o_stream)
-
-        total_count += 1
-        if(total_count % 50 == 0):
-            print(total_count, "/", len(maestro_json))
+        tasks.append((mid, split_dir))
+
+    split_dirs  = (train_dir, val_dir, test_dir)
+    offsets     = {split_dir: [0] for split_dir in split_dirs}
+    names       = {split_dir: [] for split_dir in split_dirs}
+    shard_files = (TOKENS_FILE, OFFSETS_FILE, NAMES_FILE)
+    token_files = {split_dir: open(split_dir / (TOKENS_FILE + TMP_SUFFIX), "wb", buffering=WRITE_BUFFER_SIZE)
+                   for split_dir in split_dirs}
+
+    # Every piece is independent, so the encoding is spread over all available cores.
+    # Results come back in order and are appended to their split's shard by this process only.
+    try:
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            mids = [mid for mid, _ in tasks]
+            for (mid, split_dir), tokens in zip(tasks, executor.map(_encode_one, mids, chunksize=POOL_CHUNKSIZE)):
+                # tofile would bypass the file object's write buffer
+                token_files[split_dir].write(tokens.tobytes())
+                offsets[split_dir].append(offsets[split_dir][-1] + len(tokens))
+                names[split_dir].append(mid.name)
+
+                total_count += 1
+                if(total_count % 50 == 0):
+                    print(total_count, "/", len(entries))
+    finally:
+        for token_file in token_files.values():
+            token_file.close()
+
+    for split_dir in split_dirs:
+        # Given a file object, np.save doesn't append .npy to the temporary name
+        with open(split_dir / (OFFSETS_FILE + TMP_SUFFIX), "wb") as o_stream:
+            np.save(o_stream, np.array(offsets[split_dir], dtype=np.int64))
+        with open(split_dir / (NAMES_FILE + TMP_SUFFIX), "w") as o_stream:
+            o_stream.write("\n".join(names[split_dir]))
+
+    for split_dir in split_dirs:
+        # Windows of the previous shard would no longer match the new tokens
+        for windows_file in split_dir.glob(WINDOWS_FILE.format("*")):
+            windows_file.unlink()
+
+        for shard_file in shard_files:
+            os.replace(split_dir / (shard_file + TMP_SUFFIX), split_dir / shard_file)
+
+    # Only training uses windows, evaluation keeps one crop per piece (see create_epiano_datasets)
+    if(max_seq is not None):
+        prep_windows(train_dir, max_seq)
 
     print("Num Train:", train_count)
     print("Num Val:", val_count)
     print("Num Test:", test_count)
     return True
 
+# prep_windows
+def prep_windows(split_dir:Path, max_seq):
+    """
+    ----------
+    Author: David Pardigol
+    ----------
+    Cuts every piece of a split's token shard into windows of max_seq + 1 tokens (input and target
+    shifted by one), overlapping by half a window. The last window of a piece ends on its last token.
+    Pieces shorter than a window are followed by TOKEN_END and then padded with TOKEN_PAD. The targets
+    match process_midi, the input carries that one extra END before the padding (only feeding
+    positions whose target is PAD, so loss and accuracy are unchanged).
+
+    Saved as a (n_windows, max_seq + 1) TOKEN_DTYPE array in WINDOWS_FILE.
+    ----------
+    """
+
+    tokens      = np.fromfile(split_dir / TOKENS_FILE, dtype=TOKEN_DTYPE)
+    offsets     = np.load(split_dir / OFFSETS_FILE)
+    full_seq    = max_seq + 1
+    stride      = max(1, max_seq // 2)
+
+    windows = [np.empty((0, full_seq), dtype=TOKEN_DTYPE)]
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        piece = tokens[start:end]
+
+        if(len(piece) == 0):
+            continue
+
+        if(len(piece) < full_seq):
+            window = np.full((1, full_seq), TOKEN_PAD, dtype=TOKEN_DTYPE)
+            window[0, :len(piece)] = piece
+            window[0, len(piece)] = TOKEN_END
+            windows.append(window)
+        else:
+            last_start = len(piece) - full_seq
+            starts = list(range(0, last_start + 1, stride))
+            if(starts[-1] != last_start):
+                starts.append(last_start)
+
+            windows.append(sliding_window_view(piece, full_seq)[starts])
+
+    np.save(split_dir / WINDOWS_FILE.format(max_seq), np.concatenate(windows))
+
 # parse_args
 def parse_args():
     """
@@ -92,6 +213,7 @@ def parse_args():
 
     parser.add_argument("root", type=str, help="Root folder for the Maestro dataset or for custom data.")
     parser.add_argument("-output_dir", type=str, default="./dataset/e_piano", help="Output folder to put the preprocessed midi into.")
+    parser.add_argument("-max_sequence", type=int, default=None, help="Also cut the data into fixed windows for training with this max_sequence (see train.py).")
     return parser.parse_args()
 
 # main
@@ -110,7 +232,7 @@ def main():
 
     print("Preprocessing midi files and saving to", output_dir)
 
-    prep_maestro_midi(root, output_dir)
+    prep_maestro_midi(root, output_dir, args.max_sequence)
     
     print("Done!")
     print("")
@@ -160,6 +160,35 @@ def _make_time_sift_events(prev_time, post_time):
         return results + [Event(event_type='time_shift', value=time_interval-1)]
 
 
+def _snote_seq2int_seq(snote_sequence):
+    # Same tokens as _make_time_sift_events + _snote2events + Event.to_int, without building
+    # an Event object per token (this loop dominates encode_midi)
+    time_shift_idx = START_IDX['time_shift']
+    velocity_idx = START_IDX['velocity']
+    result = []
+    append = result.append
+
+    cur_time = 0
+    cur_vel = 0
+    for snote in snote_sequence:
+        time_interval = int(round((snote.time - cur_time) * 100))
+        while time_interval >= RANGE_TIME_SHIFT:
+            append(time_shift_idx + RANGE_TIME_SHIFT - 1)
+            time_interval -= RANGE_TIME_SHIFT
+        if time_interval != 0:
+            append(time_shift_idx + time_interval - 1)
+
+        if snote.velocity is not None:
+            modified_velocity = snote.velocity // 4
+            if cur_vel != modified_velocity:
+                append(velocity_idx + modified_velocity)
+        append(START_IDX[snote.type] + snote.value)
+
+        cur_time = snote.time
+        cur_vel = snote.velocity
+    return result
+
+
 def _control_preprocess(ctrl_changes):
     sustains = []
 
@@ -200,7 +229,6 @@ def _note_preprocess(susteins, notes):
 
 
 def encode_midi(file_path):
-    events = []
     notes = []
     mid = pretty_midi.PrettyMIDI(midi_file=file_path)
 
@@ -217,17 +245,7 @@ def encode_midi(file_path):
     dnotes.sort(key=lambda x: x.time)
     # print('sorted:')
     # print(dnotes)
-    cur_time = 0
-    cur_vel = 0
-    for snote in dnotes:
-        events += _make_time_sift_events(prev_time=cur_time, post_time=snote.time)
-        events += _snote2events(snote=snote, prev_vel=cur_vel)
-        # events += _make_time_sift_events(prev_time=cur_time, post_time=snote.time)
-
-        cur_time = snote.time
-        cur_vel = snote.velocity
-
-    return [e.to_int() for e in events]
+    return _snote_seq2int_seq(dnotes)
 
 
 def decode_midi(idx_array, file_path=None):
@@ -1,17 +1,18 @@
 import os
+import math
 from pathlib import Path
 import csv
+from concurrent.futures import ThreadPoolExecutor
 import shutil
 import torch
 import torch.nn as nn
 from torch.optim.lr_scheduler import LambdaLR
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, RandomSampler
 from torch.optim import Adam
 
 from dataset.e_piano import create_epiano_datasets, compute_epiano_accuracy
 
 from model.music_transformer import MusicTransformer
-from model.loss import SmoothCrossEntropyLoss
 
 from utilities.constants import *
 from utilities.device import get_device, use_cuda
@@ -24,6 +25,52 @@ CSV_HEADER = ["Epoch", "Learn rate", "Avg Train loss", "Train Accuracy", "Avg Ev
 # Baseline is an untrained epoch that we evaluate as a baseline loss and accuracy
 BASELINE_EPOCH = -1
 
+# Batches loaded in advance by each Dataloader worker
+LOADER_PREFETCH_FACTOR = 2
+
+# round_up_to_multiple
+def round_up_to_multiple(value, multiple):
+    """
+    ----------
+    Author: David Pardigol
+    ----------
+    Rounds value up to the nearest multiple of multiple
+    ----------
+    """
+
+    return ((value + multiple - 1) // multiple) * multiple
+
+# cpu_state_dict
+def cpu_state_dict(model, pin_memory=False):
+    """
+    ----------
+    Author: David Pardigol
+    ----------
+    Allocates cpu tensors matching the model's state_dict, to be filled with copy_state_dict.
+    Pinned memory lets the copies from cuda run asynchronously.
+    ----------
+    """
+
+    return {k: torch.empty(v.shape, dtype=v.dtype, device="cpu", pin_memory=pin_memory)
+            for k, v in model.state_dict().items()}
+
+# copy_state_dict
+def copy_state_dict(model, cpu_state, device):
+    """
+    ----------
+    Author: David Pardigol
+    ----------
+    Copies the model's state_dict into the tensors allocated by cpu_state_dict, waiting for the
+    copies to finish when the model is on cuda
+    ----------
+    """
+
+    for k, v in model.state_dict().items():
+        cpu_state[k].copy_(v.detach(), non_blocking=True)
+
+    if(device.type == "cuda"):
+        torch.cuda.synchronize()
+
 # main
 def main():
     """
@@ -39,6 +86,24 @@ def main():
 
     device=torch.device("cpu")
 
+    ##### Tensor core friendly shapes #####
+    # Lets cuda use TF32 tensor cores for fp32 matmuls, and rounds the layer dimensions up to a
+    # multiple tensor cores handle (keeping d_model divisible by num_heads)
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision("high")
+
+    if(device.type == "cuda"):
+        d_model_multiple = TENSOR_CORE_MULTIPLE * args.num_heads // math.gcd(TENSOR_CORE_MULTIPLE, args.num_heads)
+        d_model = round_up_to_multiple(args.d_model, d_model_multiple)
+        dim_feedforward = round_up_to_multiple(args.dim_feedforward, TENSOR_CORE_MULTIPLE)
+
+        if(d_model != args.d_model or dim_feedforward != args.dim_feedforward):
+            print("WARNING: Rounded d_model to", d_model, "and dim_feedforward to", dim_feedforward, "for tensor cores")
+            print("")
+            args.d_model = d_model
+            args.dim_feedforward = dim_feedforward
+
     output_dir = Path(args.output_dir)
     output_dir.mkdir(exist_ok=True)
 
@@ -72,12 +137,28 @@ def main():
     #Each torch dataset contains tuples : dim(sequence, sequence shifted by one)=(max_sequence,max_sequence)
     #Last element of training set :
     #  (tensor([365,  32, 261,  ..., 257, 174, 370]), tensor([ 32, 261, 380,  ..., 174, 370,  46]))
-    train_dataset, _, test_dataset = create_epiano_datasets(input_dir, args.max_sequence)
+    # Trains on the fixed windows from preprocess_midi.py -max_sequence when they exist, the test set
+    # is always one crop per piece
+    train_dataset, _, test_dataset = create_epiano_datasets(input_dir, args.max_sequence, windowed=True)
+
+    # Pinned memory lets the host to device copies run asynchronously, only useful with cuda.
+    # Workers are kept alive between epochs since the loaders are iterated every epoch.
+    loader_kwargs = dict(batch_size=args.batch_size, num_workers=args.n_workers,
+                         pin_memory=(device.type == "cuda"))
+    if(args.n_workers > 0):
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=LOADER_PREFETCH_FACTOR)
+
+    # The shuffle order comes from one generator for the whole run (seeded with -seed if given)
+    sampler_generator = torch.Generator()
+    if(args.seed is None):
+        sampler_generator.seed()
+    else:
+        sampler_generator.manual_seed(args.seed)
+    train_sampler = RandomSampler(train_dataset, generator=sampler_generator)
 
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, num_workers=args.n_workers, shuffle=True)
-    test_loader = DataLoader(test_dataset, batch_size=args.batch_size, num_workers=args.n_workers)
-    
-    X_test, y_test = next(iter(train_loader))
+    # drop_last keeps every train batch the same shape, eval still sees every test item
+    train_loader = DataLoader(train_dataset, sampler=train_sampler, drop_last=True, **loader_kwargs)
+    test_loader = DataLoader(test_dataset, **loader_kwargs)
 
     model = MusicTransformer(n_layers=args.n_layers, num_heads=args.num_heads,
                 d_model=args.d_model, dim_feedforward=args.dim_feedforward, dropout=args.dropout,
@@ -96,12 +177,24 @@ def main():
         print("ERROR: Need continue weights (-continue_weights) when using continue_epoch")
         return
 
+    ##### Compiled model #####
+    # The compiled module shares its parameters with model. Weights are still loaded into and saved
+    # from model so the state_dict keys don't get the _orig_mod prefix.
+    # reduce-overhead relies on CUDA graphs and the fixed batch shape (drop_last) of the train loader,
+    # the smaller last test batch only adds one more compiled graph.
+    if(device.type == "cuda"):
+        os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", str(output_dir / "inductor_cache"))
+        compiled_model = torch.compile(model, mode="reduce-overhead", fullgraph=False, dynamic=False)
+    else:
+        compiled_model = model
+
     ##### Lr Scheduler vs static lr #####
     if(args.lr is None):
         if(args.continue_epoch is None):
             init_step = 0
         else:
-            init_step = args.continue_epoch * len(train_loader)
+            init_step = args.continue_epoch * math.ceil(len(train_loader) / args.grad_accum_steps)
 
         lr = LR_DEFAULT_START
         lr_stepper = LrStepTracker(args.d_model, SCHEDULER_WARMUP_STEPS, init_step)
@@ -111,20 +204,38 @@ def main():
     ##### Not smoothing evaluation loss #####
     eval_loss_func = nn.CrossEntropyLoss(ignore_index=TOKEN_PAD)
 
-    ##### SmoothCrossEntropyLoss or CrossEntropyLoss for training #####
+    ##### Smoothed or plain CrossEntropyLoss for training #####
+    # Built-in label smoothing matches SmoothCrossEntropyLoss (uniform over VOCAB_SIZE) in one fused op
     if(args.ce_smoothing is None):
         train_loss_func = eval_loss_func
     else:
-        train_loss_func = SmoothCrossEntropyLoss(args.ce_smoothing, VOCAB_SIZE, ignore_index=TOKEN_PAD)
+        train_loss_func = nn.CrossEntropyLoss(ignore_index=TOKEN_PAD, label_smoothing=args.ce_smoothing)
 
     ##### Optimizer #####
-    opt = Adam(model.parameters(), lr=lr, betas=(ADAM_BETA_1, ADAM_BETA_2), eps=ADAM_EPSILON)
+    # Fused single kernel update on cuda
+    opt = Adam(model.parameters(), lr=lr, betas=(ADAM_BETA_1, ADAM_BETA_2), eps=ADAM_EPSILON,
+               fused=(device.type == "cuda"))
 
     if(args.lr is None):
         lr_scheduler = LambdaLR(opt, lr_stepper.step)
     else:
         lr_scheduler = None
 
+    ##### Mixed precision #####
+    # Only used on cuda, fp16 needs the GradScaler while bf16 has the range of fp32
+    if(args.amp_dtype is not None and device.type == "cuda"):
+        amp_dtype = AMP_DTYPES[args.amp_dtype]
+    else:
+        amp_dtype = None
+        if(args.amp_dtype is not None):
+            print("WARNING: Mixed precision is only used on cuda, training in full precision")
+            print("")
+
+    if(amp_dtype == torch.float16):
+        scaler = torch.amp.GradScaler("cuda")
+    else:
+        scaler = None
+
     ##### Tracking best evaluation accuracy #####
     best_eval_acc        = 0.0
     best_eval_acc_epoch  = -1
@@ -132,93 +243,128 @@ def main():
     best_eval_loss_epoch = -1
 
     ##### Results reporting #####
-    if(not results_file.is_file()):
-        with open(results_file, "w", newline="") as o_stream:
-            writer = csv.writer(o_stream)
-            writer.writerow(CSV_HEADER)
-
+    # Both files stay open for the whole run and are flushed after every write
+    results_stream = open(results_file, "a", newline="")
+    results_writer = csv.writer(results_stream)
+    if(results_stream.tell() == 0):
+        results_writer.writerow(CSV_HEADER)
+        results_stream.flush()
+
+    # Not truncated on open, previous bests are kept until a new best replaces them
+    best_stream = open(best_text, "a")
+
+    ##### Checkpointing #####
+    # Weights are written by a background thread so training doesn't wait on the disk
+    # The weights are snapshot once per epoch into a cpu copy allocated once for the whole run
+    save_executor = ThreadPoolExecutor(max_workers=1)
+    pending_saves = []
+    cpu_state = cpu_state_dict(model, pin_memory=(device.type == "cuda"))
 
     ##### TRAIN LOOP #####
-    for epoch in range(start_epoch, args.epochs):
-        # Baseline has no training and acts as a base loss and accuracy (epoch 0 in a sense)
-        if(epoch > BASELINE_EPOCH):
-            print(SEPERATOR)
-            print("NEW EPOCH:", epoch+1)
-            print(SEPERATOR)
+    try:
+        for epoch in range(start_epoch, args.epochs):
+            # Baseline has no training and acts as a base loss and accuracy (epoch 0 in a sense)
+            if(epoch > BASELINE_EPOCH):
+                print(SEPERATOR)
+                print("NEW EPOCH:", epoch+1)
+                print(SEPERATOR)
+                print("")
+
+                # Train
+                train_loss, train_acc = train_epoch(epoch+1, compiled_model, train_loader, train_loss_func, opt, lr_scheduler, args.print_modulus,
+                                                    scaler=scaler, amp_dtype=amp_dtype, grad_accum_steps=args.grad_accum_steps)
+
+                print(SEPERATOR)
+                print("Evaluating:")
+            else:
+                print(SEPERATOR)
+                print("Baseline model evaluation (Epoch 0):")
+
+            # Eval
+            # Train loss and accuracy come from train_epoch, only the baseline (nothing trained) or an
+            # explicit train_eval_modulus runs a separate pass over the train set
+            if(epoch == BASELINE_EPOCH or
+               (args.train_eval_modulus is not None and (epoch+1) % args.train_eval_modulus == 0)):
+                print("Computing train loss and train accuracy...")
+                print("")
+                train_loss, train_acc = eval_model(compiled_model, train_loader, train_loss_func, amp_dtype=amp_dtype)
+                print("Train loss and train accuracy finished !")
+                print("")
+            print("Computing eval loss and eval accuracy...")
+            print("")
+            eval_loss, eval_acc = eval_model(compiled_model, test_loader, eval_loss_func, amp_dtype=amp_dtype)
+            print("Eval loss and eval accuracy finished !")
             print("")
 
-            # Train
-            train_epoch(epoch+1, model, train_loader, train_loss_func, opt, lr_scheduler, args.print_modulus)
+            # Learn rate
+            lr = get_lr(opt)
 
+            print("Epoch:", epoch+1)
+            print("Avg train loss:", train_loss)
+            print("Avg train acc:", train_acc)
+            print("Avg eval loss:", eval_loss)
+            print("Avg eval acc:", eval_acc)
             print(SEPERATOR)
-            print("Evaluating:")
-        else:
-            print(SEPERATOR)
-            print("Baseline model evaluation (Epoch 0):")
-
-        # Eval
-        print("Computing train loss and train accuracy...")
-        print("")
-        train_loss, train_acc = eval_model(model, train_loader, train_loss_func)
-        print("Train loss and train accuracy finished !")
-        print("")
-        print("Computing eval loss and eval accuracy...")
-        print("")
-        eval_loss, eval_acc = eval_model(model, test_loader, eval_loss_func)
-        print("Eval loss and eval accuracy finished !")
-        print("")
-
-        # Learn rate
-        lr = get_lr(opt)
-
-        print("Epoch:", epoch+1)
-        print("Avg train loss:", train_loss)
-        print("Avg train acc:", train_acc)
-        print("Avg eval loss:", eval_loss)
-        print("Avg eval acc:", eval_acc)
-        print(SEPERATOR)
-        print("")
-
-        new_best = False
-
-        if(eval_acc > best_eval_acc):
-            best_eval_acc = eval_acc
-            best_eval_acc_epoch  = epoch+1
-            torch.save(model.state_dict(), best_acc_file)
-            new_best = True
-
-        if(eval_loss < best_eval_loss):
-            best_eval_loss       = eval_loss
-            best_eval_loss_epoch = epoch+1
-            torch.save(model.state_dict(), best_loss_file)
-            new_best = True
-
-        # Writing out new bests
-        if(new_best):
-            with open(best_text, "w") as o_stream:
-                print("Best eval acc epoch:", best_eval_acc_epoch, file=o_stream)
-                print("Best eval acc:", best_eval_acc, file=o_stream)
+            print("")
+
+            new_best = False
+            save_files = []
+
+            if(eval_acc > best_eval_acc):
+                best_eval_acc = eval_acc
+                best_eval_acc_epoch  = epoch+1
+                save_files.append(best_acc_file)
+                new_best = True
+
+            if(eval_loss < best_eval_loss):
+                best_eval_loss       = eval_loss
+                best_eval_loss_epoch = epoch+1
+                save_files.append(best_loss_file)
+                new_best = True
+
+            # Writing out new bests
+            if(new_best):
+                best_stream.seek(0)
+                best_stream.truncate()
+                print("Best eval acc epoch:", best_eval_acc_epoch, file=best_stream)
+                print("Best eval acc:", best_eval_acc, file=best_stream)
                 print("")
-                print("Best eval loss epoch:", best_eval_loss_epoch, file=o_stream)
-                print("Best eval loss:", best_eval_loss, file=o_stream)
-
-
-        if(not args.no_tensorboard):
-            tensorboard_summary.add_scalar("Avg_CE_loss/train", train_loss, global_step=epoch+1)
-            tensorboard_summary.add_scalar("Avg_CE_loss/eval", eval_loss, global_step=epoch+1)
-            tensorboard_summary.add_scalar("Accuracy/train", train_acc, global_step=epoch+1)
-            tensorboard_summary.add_scalar("Accuracy/eval", eval_acc, global_step=epoch+1)
-            tensorboard_summary.add_scalar("Learn_rate/train", lr, global_step=epoch+1)
-            tensorboard_summary.flush()
-
-        if((epoch+1) % args.weight_modulus == 0):
-            epoch_str = str(epoch+1).zfill(PREPEND_ZEROS_WIDTH)
-            path = os.path.join(weights_folder, "epoch_" + epoch_str + ".pickle")
-            torch.save(model.state_dict(), path)
-
-        with open(results_file, "a", newline="") as o_stream:
-            writer = csv.writer(o_stream)
-            writer.writerow([epoch+1, lr, train_loss, train_acc, eval_loss, eval_acc])
+                print("Best eval loss epoch:", best_eval_loss_epoch, file=best_stream)
+                print("Best eval loss:", best_eval_loss, file=best_stream)
+                best_stream.flush()
+
+
+            # Events are buffered and flushed by the writer itself (every flush_secs)
+            if(not args.no_tensorboard):
+                tensorboard_summary.add_scalar("Avg_CE_loss/train", train_loss, global_step=epoch+1)
+                tensorboard_summary.add_scalar("Avg_CE_loss/eval", eval_loss, global_step=epoch+1)
+                tensorboard_summary.add_scalar("Accuracy/train", train_acc, global_step=epoch+1)
+                tensorboard_summary.add_scalar("Accuracy/eval", eval_acc, global_step=epoch+1)
+                tensorboard_summary.add_scalar("Learn_rate/train", lr, global_step=epoch+1)
+
+            if((epoch+1) % args.weight_modulus == 0):
+                epoch_str = str(epoch+1).zfill(PREPEND_ZEROS_WIDTH)
+                path = os.path.join(weights_folder, "epoch_" + epoch_str + ".pickle")
+                save_files.append(path)
+
+            if(len(save_files) > 0):
+                # Last epoch's saves may still be reading cpu_state, result() raises their errors
+                for pending_save in pending_saves:
+                    pending_save.result()
+
+                copy_state_dict(model, cpu_state, device)
+                pending_saves = [save_executor.submit(torch.save, cpu_state, f) for f in save_files]
+
+            results_writer.writerow([epoch+1, lr, train_loss, train_acc, eval_loss, eval_acc])
+            results_stream.flush()
+    finally:
+        results_stream.close()
+        best_stream.close()
+
+    # Waiting on the last checkpoints, result() raises any error from the save thread
+    save_executor.shutdown(wait=True)
+    for pending_save in pending_saves:
+        pending_save.result()
 
     # Sanity check just to make sure everything is gone
     if(not args.no_tensorboard):
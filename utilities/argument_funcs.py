@@ -14,10 +14,11 @@ def parse_train_args():
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("-input_dir", type=str, default="./dataset/e_piano", help="Folder of preprocessed and pickled midi files")
+    parser.add_argument("-input_dir", type=str, default="./dataset/e_piano", help="Folder of preprocessed midi token shards (preprocess_midi.py)")
     parser.add_argument("-output_dir", type=str, default="./saved_models", help="Folder to save model weights. Saves one every epoch")
     parser.add_argument("-weight_modulus", type=int, default=1, help="How often to save epoch weights (ex: value of 10 means save every 10 epochs)")
     parser.add_argument("-print_modulus", type=int, default=1, help="How often to print train results for a batch (batch loss, learn rate, etc.)")
+    parser.add_argument("-train_eval_modulus", type=int, default=None, help="How often to recompute train loss and accuracy in eval mode over the train set (defaults to the running average of the training batches)")
 
     parser.add_argument("-n_workers", type=int, default=1, help="Number of threads for the dataloader")
     parser.add_argument("--force_cpu", action="store_true", help="Forces model to run on a cpu even when gpu is available")
@@ -30,6 +31,9 @@ def parse_train_args():
     parser.add_argument("-ce_smoothing", type=float, default=None, help="Smoothing parameter for smoothed cross entropy loss (defaults to no smoothing)")
     parser.add_argument("-batch_size", type=int, default=2, help="Batch size to use")
     parser.add_argument("-epochs", type=int, default=100, help="Number of epochs to use")
+    parser.add_argument("-seed", type=int, default=None, help="Seed for the train set shuffle order (defaults to a random seed)")
+    parser.add_argument("-grad_accum_steps", type=int, default=1, help="Number of batches to accumulate gradients over before each optimizer step")
+    parser.add_argument("-amp_dtype", type=str, default=None, choices=["fp16", "bf16"], help="Mixed precision dtype used on cuda (defaults to full precision). fp16 uses gradient scaling, bf16 needs Ampere or newer")
 
     parser.add_argument("--rpr", action="store_true", help="Use a modified Transformer for Relative Position Representations")
     parser.add_argument("-max_sequence", type=int, default=2048, help="Maximum midi sequence to consider")
@@ -41,7 +45,12 @@ def parse_train_args():
 
     parser.add_argument("-dropout", type=float, default=0.1, help="Dropout rate")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+
+    if(args.grad_accum_steps < 1):
+        parser.error("-grad_accum_steps must be at least 1")
+
+    return args
 
 # print_train_args
 def print_train_args(args):
@@ -58,6 +67,7 @@ def print_train_args(args):
     print("output_dir:", args.output_dir)
     print("weight_modulus:", args.weight_modulus)
     print("print_modulus:", args.print_modulus)
+    print("train_eval_modulus:", args.train_eval_modulus)
     print("")
     print("n_workers:", args.n_workers)
     print("force_cpu:", args.force_cpu)
@@ -70,6 +80,9 @@ def print_train_args(args):
     print("ce_smoothing:", args.ce_smoothing)
     print("batch_size:", args.batch_size)
     print("epochs:", args.epochs)
+    print("seed:", args.seed)
+    print("grad_accum_steps:", args.grad_accum_steps)
+    print("amp_dtype:", args.amp_dtype)
     print("")
     print("rpr:", args.rpr)
     print("max_sequence:", args.max_sequence)
@@ -94,7 +107,7 @@ def parse_eval_args():
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("-dataset_dir", type=str, default="./dataset/e_piano", help="Folder of preprocessed and pickled midi files")
+    parser.add_argument("-dataset_dir", type=str, default="./dataset/e_piano", help="Folder of preprocessed midi token shards (preprocess_midi.py)")
     parser.add_argument("-model_weights", type=str, default="./saved_models/model.pickle", help="Pickled model weights file saved with torch.save and model.state_dict()")
     parser.add_argument("-n_workers", type=int, default=1, help="Number of threads for the dataloader")
     parser.add_argument("--force_cpu", action="store_true", help="Forces model to run on a cpu even when gpu is available")
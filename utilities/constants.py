@@ -1,6 +1,7 @@
 import torch
 
-from third_party.midi_processor.processor import RANGE_NOTE_ON, RANGE_NOTE_OFF, RANGE_VEL, RANGE_TIME_SHIFT
+from utilities.token_constants import TOKEN_END, TOKEN_PAD, VOCAB_SIZE
+from utilities.token_constants import TOKEN_DTYPE, TOKENS_FILE, OFFSETS_FILE, NAMES_FILE, WINDOWS_FILE
 
 SEPERATOR               = "========================="
 
@@ -15,16 +16,17 @@ SCHEDULER_WARMUP_STEPS  = 4000
 
 # DROPOUT_P               = 0.1
 
-TOKEN_END               = RANGE_NOTE_ON + RANGE_NOTE_OFF + RANGE_VEL + RANGE_TIME_SHIFT
-TOKEN_PAD               = TOKEN_END + 1
-
-VOCAB_SIZE              = TOKEN_PAD + 1
-
 TORCH_FLOAT             = torch.float32
 TORCH_INT               = torch.int32
 
 TORCH_LABEL_TYPE        = torch.long
 
+# Layer dimensions are rounded up to a multiple of this on cuda (tensor core friendly shapes)
+TENSOR_CORE_MULTIPLE    = 8
+
+# Mixed precision dtypes selectable with -amp_dtype
+AMP_DTYPES              = {"fp16": torch.float16, "bf16": torch.bfloat16}
+
 PREPEND_ZEROS_WIDTH     = 4
 
 NUM_EXAMPLES = 1
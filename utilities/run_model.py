@@ -1,6 +1,8 @@
 import torch
+from torch.nn.parallel import DistributedDataParallel
 import time
 import itertools
+import contextlib
 
 from .constants import *
 from utilities.device import get_device
@@ -10,39 +12,87 @@ from dataset.e_piano import compute_epiano_accuracy
 
 
 # train_epoch
-def train_epoch(cur_epoch, model, dataloader, loss, opt, lr_scheduler=None, print_modulus=1):
+def train_epoch(cur_epoch, model, dataloader, loss, opt, lr_scheduler=None, print_modulus=1, scaler=None, amp_dtype=None,
+                grad_accum_steps=1):
     """
     ----------
     Author: Damon Gwinn
     ----------
-    Trains a single model epoch
+    Trains a single model epoch. Returns the average loss and accuracy over the trained batches
+    (computed in train mode, so with dropout active).
+
+    With amp_dtype set, the forward pass and loss run under autocast. A GradScaler given as scaler
+    is used to scale the loss for the backward pass and the optimizer step (needed for fp16).
+
+    Gradients are accumulated over grad_accum_steps batches before each optimizer and lr_scheduler
+    step. When the batch count isn't a multiple of grad_accum_steps, the last batches form a smaller
+    window that still steps (averaged over its own size). A DistributedDataParallel model only
+    all-reduces on the batch that steps.
     ----------
     """
 
     out = -1
+    sum_loss    = 0.0
+    sum_acc     = 0.0
+    n_batches   = 0
     model.train()
+    opt.zero_grad(set_to_none=True)
+
+    n_batches_total     = min(len(dataloader), NUM_EXAMPLES)
+    last_window_start   = (n_batches_total // grad_accum_steps) * grad_accum_steps
     # Every call to the dataset iterator will return batch of images of size batch_size. 
     # Hence you will have batch_size batches until you exhaust all the len(dataloader) images.
     for batch_num, batch in enumerate(itertools.islice(dataloader, NUM_EXAMPLES)):
         time_before = time.time()
 
-        opt.zero_grad()
+        x   = batch[0].to(get_device(), non_blocking=True)
+        tgt = batch[1].to(get_device(), non_blocking=True)
+
+        is_step = ((batch_num+1) % grad_accum_steps == 0 or (batch_num+1) == n_batches_total)
+        if(batch_num < last_window_start):
+            window_size = grad_accum_steps
+        else:
+            window_size = n_batches_total - last_window_start
+
+        if(isinstance(model, DistributedDataParallel) and not is_step):
+            sync_context = model.no_sync
+        else:
+            sync_context = contextlib.nullcontext
+
+        with sync_context():
+            with torch.autocast(device_type=get_device().type, dtype=amp_dtype, enabled=(amp_dtype is not None)):
+                y = model(x)
 
-        x   = batch[0].to(get_device())
-        tgt = batch[1].to(get_device())
+                # Kept as tensors to avoid a device sync every batch
+                with torch.no_grad():
+                    sum_acc += compute_epiano_accuracy(y, tgt)
 
-        y = model(x)
+                y   = y.reshape(y.shape[0] * y.shape[1], -1)
+                tgt = tgt.flatten()
 
-        y   = y.reshape(y.shape[0] * y.shape[1], -1)
-        tgt = tgt.flatten()
+                out = loss.forward(y, tgt)
 
-        out = loss.forward(y, tgt)
+            # Scaled so the accumulated gradient is the average over the accumulated batches
+            accum_out = out / window_size
+            if(scaler is not None):
+                scaler.scale(accum_out).backward()
+            else:
+                accum_out.backward()
 
-        out.backward()
-        opt.step()
+        sum_loss += out.detach()
+        n_batches += 1
 
-        if(lr_scheduler is not None):
-            lr_scheduler.step()
+        if(is_step):
+            if(scaler is not None):
+                scaler.step(opt)
+                scaler.update()
+            else:
+                opt.step()
+
+            opt.zero_grad(set_to_none=True)
+
+            if(lr_scheduler is not None):
+                lr_scheduler.step()
 
         time_after = time.time()
         time_took = time_after - time_before
@@ -57,34 +107,44 @@ def train_epoch(cur_epoch, model, dataloader, loss, opt, lr_scheduler=None, prin
             print(SEPERATOR)
             print("")
 
-    return
+    if(n_batches == 0):
+        return -1, -1
+
+    avg_loss    = float(sum_loss) / n_batches
+    avg_acc     = float(sum_acc) / n_batches
+
+    return avg_loss, avg_acc
 
 # eval_model
-def eval_model(model, dataloader, loss):
+def eval_model(model, dataloader, loss, amp_dtype=None):
 
     model.eval()
 
     avg_acc     = -1
     avg_loss    = -1
-    with torch.set_grad_enabled(False):
-        n_test      = len(dataloader)
+    with torch.inference_mode():
+        # Counts the batches actually evaluated (islice), same averaging as train_epoch
+        n_test      = 0
         sum_loss   = 0.0
         sum_acc    = 0.0
         for batch in itertools.islice(dataloader, NUM_EXAMPLES): 
-            x   = batch[0].to(get_device())
-            tgt = batch[1].to(get_device())
-            y = model(x)
+            x   = batch[0].to(get_device(), non_blocking=True)
+            tgt = batch[1].to(get_device(), non_blocking=True)
+            with torch.autocast(device_type=get_device().type, dtype=amp_dtype, enabled=(amp_dtype is not None)):
+                y = model(x)
 
-            sum_acc += float(compute_epiano_accuracy(y, tgt))
+                sum_acc += float(compute_epiano_accuracy(y, tgt))
 
-            y   = y.reshape(y.shape[0] * y.shape[1], -1)
-            tgt = tgt.flatten()
+                y   = y.reshape(y.shape[0] * y.shape[1], -1)
+                tgt = tgt.flatten()
 
-            out = loss.forward(y, tgt)
+                out = loss.forward(y, tgt)
 
             sum_loss += float(out)
+            n_test += 1
 
-        avg_loss    = sum_loss / n_test
-        avg_acc     = sum_acc / n_test
+        if(n_test > 0):
+            avg_loss    = sum_loss / n_test
+            avg_acc     = sum_acc / n_test
 
     return avg_loss, avg_acc
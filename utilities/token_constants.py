@@ -0,0 +1,18 @@
+# Token and preprocessed data constants without any torch import, so preprocess_midi.py (and every
+# one of its pool workers) doesn't have to load torch. Re-exported by utilities/constants.py.
+
+import numpy as np
+
+from third_party.midi_processor.processor import RANGE_NOTE_ON, RANGE_NOTE_OFF, RANGE_VEL, RANGE_TIME_SHIFT
+
+TOKEN_END               = RANGE_NOTE_ON + RANGE_NOTE_OFF + RANGE_VEL + RANGE_TIME_SHIFT
+TOKEN_PAD               = TOKEN_END + 1
+
+VOCAB_SIZE              = TOKEN_PAD + 1
+
+# Preprocessed shard layout (preprocess_midi.py), one of each per split folder
+TOKEN_DTYPE             = np.int16
+TOKENS_FILE             = "tokens.bin"
+OFFSETS_FILE            = "offsets.npy"
+NAMES_FILE              = "names.txt"
+WINDOWS_FILE            = "windows_{}.npy" # Formatted with max_sequence